@@ -32,13 +32,19 @@ __author__ = 'Jack G5JDA'
 
 import time
 import argparse
+import functools
 import logging
+import multiprocessing
+from datetime import date
 from modules import sota_csv
 from modules import sota_api
 from modules import adif
+from modules import log_setup
+from modules import sota_ref
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # needed for -j worker processes in the pyinstaller windows .exe
     time_start = time.time()  # to measure time taken
 
     # setup command line arguments and parser
@@ -61,6 +67,41 @@ if __name__ == '__main__':
                         help='path to use for SOTAtoADIF debug logging output file, appends, best used with -v'
                              ' (omit to print to console)')
 
+    parser.add_argument('-j', '--jobs', metavar='workers', type=int, default=1,
+                        help='number of worker processes used to parse the CSV log, useful for very large logs '
+                             '(default 1, i.e. no parallel parsing)')
+
+    parser.add_argument('--since', metavar='YYYY-MM-DD', type=date.fromisoformat,
+                        help='only convert QSOs made on or after this date')
+
+    parser.add_argument('--until', metavar='YYYY-MM-DD', type=date.fromisoformat,
+                        help='only convert QSOs made on or before this date')
+
+    parser.add_argument('--callsign', metavar='station_callsign',
+                        help='only convert QSOs made with this station callsign (whole callsign, not case '
+                             'sensitive, e.g. G5JDA/P)')
+
+    parser.add_argument('--summit', metavar='summit_ref',
+                        help='only convert QSOs made from this summit (e.g. G/LD-001)')
+
+    parser.add_argument('--date-ordered', action='store_true',
+                        help='the SOTA CSV log is sorted by date, so reading can stop early with --since / --until '
+                             '(ignored with -j, workers always read their whole chunk)')
+
+    parser.add_argument('--api-url', metavar='api_url_base', default=sota_api.default_api_url_base,
+                        help='base URL of the SOTA API, e.g. to use a local simulator for testing '
+                             '(default %(default)s)')
+
+    parser.add_argument('--cache', metavar='summit_cache_path',
+                        help='path to a summit data cache file, kept between runs to avoid repeat API downloads '
+                             '(created if missing, omit to disable caching between runs)')
+
+    parser.add_argument('--cache-max-age', metavar='days', type=float, default=7,
+                        help='days before cached summit data is revalidated with the SOTA API (default %(default)s)')
+
+    parser.add_argument('--log-json', action='store_true',
+                        help='write log output as JSON lines (one JSON object per log message), best used with -l')
+
     logging_group = parser.add_mutually_exclusive_group()  # verbose and quiet modes are mutually exclusive
 
     logging_group.add_argument('-q', '--quiet', action='store_true',
@@ -71,6 +112,17 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    # check filter args make sense before doing anything
+    if args.summit:
+        summit_filter = sota_ref.normalise_ref(args.summit)
+        if not summit_filter:
+            parser.error('--summit {} is not a valid summit reference'.format(args.summit))
+    else:
+        summit_filter = None
+
+    if args.since and args.until and args.since > args.until:
+        parser.error('--since date is after --until date')
+
     # setup python logging
     log_level = logging.INFO  # default to INFO level
     log_format = '%(levelname)s: %(message)s'  # default log format
@@ -84,12 +136,21 @@ if __name__ == '__main__':
 
     # apply logging config
     if args.log:
-        logging.basicConfig(filename=args.log, encoding='utf-8', level=log_level, format=log_format)
+        log_handler = logging.FileHandler(args.log, encoding='utf-8')
+    else:
+        log_handler = logging.StreamHandler()
+
+    if args.log_json:
+        log_handler.setFormatter(log_setup.JsonLinesFormatter())
+    else:
+        log_handler.setFormatter(logging.Formatter(log_format))
+
+    logging.basicConfig(level=log_level, handlers=[log_handler])
+
+    if args.log and not args.log_json:
         logging.info('=*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*=')
         logging.info('=*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*=')
         logging.info('=*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*==*=*=*=*=*=*=*=*=*=*=')
-    else:
-        logging.basicConfig(level=log_level, format=log_format)
 
     # start program, end of setup steps
     logging.info('Starting SOTAtoADIF.')
@@ -102,10 +163,23 @@ if __name__ == '__main__':
         exit(1)
 
     # main program flow
+    sota_api.set_api_url_base(args.api_url)  # where summit data lookups are sent
+    if args.cache:
+        sota_api.cache_max_age = args.cache_max_age * 24 * 60 * 60
+        sota_api.load_summit_cache(args.cache)  # load summit data cached by previous runs
     main_log_path = args.sota_log_path  # get the path to main log file CSV (activator/chaser)
-    main_log_rows = sota_csv.read_log(main_log_path)  # read CSV rows into list
-    main_log_dict = sota_csv.process_qsos(main_log_rows)  # process rows into QSO dict
+    filters = sota_csv.make_filters(args.since, args.until, args.callsign, summit_filter, args.date_ordered)
+    if args.jobs > 1:
+        # read, process & prepare in parallel, preparing is most of the work so the workers do that too
+        main_log_dict = sota_csv.process_log_parallel(main_log_path, args.jobs, filters,
+                                                      functools.partial(adif.prepare_qsos, log_summary=False))
+    else:
+        main_log_rows = sota_csv.read_log(main_log_path, filters)  # read selected CSV rows into list
+        main_log_dict = sota_csv.process_qsos(main_log_rows)  # process rows into QSO dict
+        main_log_dict = adif.prepare_qsos(main_log_dict)  # drop QSOs that can't be output, before any API calls
     main_log_dict = sota_api.enrich_qsos(main_log_dict)  # enrich QSOs with API data
+    if args.cache:
+        sota_api.save_summit_cache(args.cache)  # keep summit data for next time
     adif.output_logs(main_log_dict)  # convert to ADIF and output files
 
     duration = round(time.time() - time_start, 2)
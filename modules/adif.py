@@ -23,6 +23,8 @@ Handles production of ADIF format including output of files
 import logging
 from datetime import datetime, timezone
 from modules import adif_enums
+from modules import sota_csv
+from modules import sota_ref
 from SOTAtoADIF import __version__
 
 
@@ -50,11 +52,92 @@ def generate_header(callsign, now):
     return header
 
 
+def adif_time(time_string):
+    """
+    Converts a QSO time string to ADIF time format
+    :param time_string: time as HH:MM or HHMM (optionally with seconds, HH:MM:SS or HHMMSS)
+    :return: ADIF time string e.g. '1015' or '101530'
+    :raises ValueError: if time_string is not a valid time in one of the accepted formats
+    """
+    # lengths are checked since strptime also accepts single digit hours / minutes / seconds (e.g. '10156')
+    time_formats = {5: ("%H:%M", "%H%M"), 4: ("%H%M", "%H%M"), 8: ("%H:%M:%S", "%H%M%S"), 6: ("%H%M%S", "%H%M%S")}
+
+    if len(time_string) in time_formats:
+        time_format, adif_format = time_formats[len(time_string)]
+        return datetime.strptime(time_string, time_format).strftime(adif_format)
+
+    raise ValueError("time {} is not in a supported format".format(time_string))
+
+
+def prepare_qsos(log_dict, log_summary=True):
+    """
+    Converts QSO fields to ADIF enums / formats and drops QSOs that can't be output, before enrichment.
+    This way no API lookups are spent on summits of QSOs that would be skipped anyway.
+    Adds 'band', 'adif_mode', 'adif_sub_mode', 'adif_date' and 'adif_time' to each QSO kept.
+    :param log_dict: dict in format output by sota_csv.process_qsos()
+    :param log_summary: False to leave out the start and skipped count messages, e.g. for each chunk of a log
+        prepared by sota_csv.process_log_parallel() (which logs a total instead)
+    :return: dict in the same format, only containing QSOs that can be output (if enrichment succeeds)
+    """
+    prepared_dict = {}
+    skipped_count = 0
+
+    if log_summary:
+        logging.info("Validating QSOs for ADIF output.")
+
+    for callsign in log_dict.keys():
+        prepared_dict[callsign] = []
+
+        for qso in log_dict[callsign]:
+            # conversions to ADIF enums / formats
+            band = adif_enums.frequency_to_band(qso['frequency'])
+            if not band:
+                message = "\nNot outputting QSO since band lookup failed."
+                message += " Callsign: {}. QSO: {}.".format(callsign, str(qso))
+                logging.warning(message)
+                skipped_count += 1
+                continue  # skip this QSO
+
+            try:
+                date = sota_csv.parse_date(qso['date'])  # same parser as the --since / --until filters
+                if not date:
+                    raise ValueError("date {} is not a valid dd/mm/yyyy date".format(qso['date']))
+                time = adif_time(qso['time'])
+            except ValueError:
+                message = "\nNot outputting QSO since date or time is not valid."
+                message += " Callsign: {}. QSO: {}.".format(callsign, str(qso))
+                logging.warning(message)
+                skipped_count += 1
+                continue  # skip this QSO
+
+            # my_gridsquare comes from the summit locator, which can't be found without a valid summit ref
+            if not sota_ref.normalise_ref(qso['summit']):
+                message = "\nNot outputting QSO since summit ref is missing or malformed and not using chaser mode."
+                message += " Callsign: {}. QSO: {}.".format(callsign, str(qso))
+                logging.warning(message)
+                skipped_count += 1
+                continue  # skip this QSO
+
+            modes = adif_enums.enum_mode(qso['mode'])
+
+            qso['band'] = band
+            qso['adif_mode'] = modes['mode']
+            qso['adif_sub_mode'] = modes['sub_mode']
+            qso['adif_date'] = date
+            qso['adif_time'] = time
+            prepared_dict[callsign].append(qso)
+
+    if log_summary:
+        logging.info("Skipped {} QSOs that can't be output.".format(skipped_count))
+
+    return prepared_dict
+
+
 def generate_qsos(station_callsign, qso_list):
     """
     Generate ADIF format string containing QSOs
     :param station_callsign: callsign of the logger's station
-    :param qso_list: list of QSOs
+    :param qso_list: list of QSOs, already prepared by prepare_qsos()
     :return: string containing QSOs in ADIF record format
     """
     qsos_adif = ''
@@ -62,14 +145,11 @@ def generate_qsos(station_callsign, qso_list):
     logging.debug("Generating ADIF QSO records for callsign {}".format(station_callsign))
 
     for qso in qso_list:
-        # conversions to ADIF enums / formats
-        band = adif_enums.frequency_to_band(qso['frequency'])
-        modes = adif_enums.enum_mode(qso['mode'])
-        mode = modes['mode']
-        sub_mode = modes['sub_mode']
-        time = qso['time'].replace(":", "")
-        date_parts = qso['date'].split("/")
-        date = str(date_parts[2]) + str(date_parts[1]) + str(date_parts[0])
+        band = qso['band']
+        mode = qso['adif_mode']
+        sub_mode = qso['adif_sub_mode']
+        date = qso['adif_date']
+        time = qso['adif_time']
 
         # assemble ADIF QSO string
         qso_adif = "<CALL:{}>{}".format(len(qso['callsign']), qso['callsign'])
@@ -83,13 +163,7 @@ def generate_qsos(station_callsign, qso_list):
         if sub_mode:
             qso_adif += "<SUBMODE:{}>{}".format(len(sub_mode), sub_mode)
 
-        if band:
-            qso_adif += "<BAND:{}>{}".format(len(band), band)
-        else:
-            message = "\nNot outputting QSO since band lookup failed."
-            message += " Callsign: {}. QSO: {}.".format(station_callsign, str(qso))
-            logging.warning(message)
-            continue  # skip this QSO
+        qso_adif += "<BAND:{}>{}".format(len(band), band)
 
         if qso.get('summit', None):
             qso_adif += "<MY_SOTA_REF:{}>{}".format(len(qso['summit']), qso['summit'])
@@ -150,7 +224,7 @@ def write_adi(adi_string, callsign, now):
 def output_logs(log_dict):
     """
     Write out the logs to ADIF files
-    :param log_dict: dict in format output by sota_csv.process_qsos()
+    :param log_dict: dict in format output by prepare_qsos(), enriched by sota_api.enrich_qsos()
     :return: Number of files written
     """
     now = datetime.now(timezone.utc).replace(microsecond=0)  # UTC time now (microseconds are unnecessary)
@@ -126,7 +126,8 @@ def enum_mode(mode_string):
 
         if not sub_mode_string:
             # we have iterated over all sub-modes and still not found a match!
-            logging.debug('Did not match mode to ADIF mode or sub mode, attempting bodge for {}'.format(mode_string))
+            # called per QSO, so lazy % args: the message is only built if debug logging is on
+            logging.debug('Did not match mode to ADIF mode or sub mode, attempting bodge for %s', mode_string)
 
             # attempt a bodge
             bodged_mode = bodge_modes(mode_string)
@@ -134,8 +135,8 @@ def enum_mode(mode_string):
             if bodged_mode:
                 mode_string = bodged_mode['mode']
                 sub_mode_string = bodged_mode['sub_mode']
-                logging.debug('Successfully bodged mode {}'.format(mode_string))
-                logging.debug('Successfully bodged sub mode {}'.format(sub_mode_string))
+                logging.debug('Successfully bodged mode %s', mode_string)
+                logging.debug('Successfully bodged sub mode %s', sub_mode_string)
 
             # bodge failed, warn
             else:
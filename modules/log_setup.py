@@ -0,0 +1,106 @@
+"""
+Copyright (c) 2024 Jack G5JDA (https://g5jda.uk)
+
+This file is part of SOTAtoADIF.
+
+SOTAtoADIF is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+SOTAtoADIF is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SOTAtoADIF.
+If not, see <https://www.gnu.org/licenses/>.
+
+
+
+log_setup.py
+
+Helpers for setting up python logging output, i.e. JSON lines format and logging from worker processes
+"""
+
+import copy
+import json
+import logging
+from datetime import datetime, timezone
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats each log record as a single line JSON object, for machine processing of debug logs
+    """
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'file': record.filename,
+                 'line': record.lineno,
+                 'function': record.funcName,
+                 'process': record.process,
+                 'message': record.getMessage()}
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text  # already formatted, e.g. records from worker processes
+
+        return json.dumps(entry)
+
+
+class _WorkerLogBuffer(logging.Handler):
+    """
+    Keeps the log records of a worker process, so the main process can write them along with the worker's results.
+    Exception text is kept out of the message, so handlers in the main process format worker records the same way as
+    their own (e.g. JsonLinesFormatter 'exception' key).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # tracebacks can't be sent between processes, the formatted text can
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        self.records.append(record)
+
+
+_worker_log_buffer = _WorkerLogBuffer()
+
+
+def init_worker_logging(level):
+    """
+    Worker process initializer, keeps log records for take_worker_log_records() instead of writing them.
+    Without this, spawned workers (e.g. on Windows) would have no logging config at all,
+    and forked workers would write to inherited handlers directly, in whatever order the workers run.
+    :param level: log level of the main process
+    """
+    root_logger = logging.getLogger()
+    root_logger.handlers = [_worker_log_buffer]
+    root_logger.setLevel(level)
+
+
+def take_worker_log_records():
+    """
+    :return: list of log records kept since the last call, to return to the main process with a worker's results
+        (empty if not called in a worker process set up by init_worker_logging())
+    """
+    records = _worker_log_buffer.records
+    _worker_log_buffer.records = []
+
+    return records
+
+
+def write_worker_log_records(records):
+    """
+    Writes log records from take_worker_log_records() with the main process' log handlers
+    :param records: list of log records
+    """
+    for record in records:
+        logging.getLogger().handle(record)
@@ -22,30 +22,152 @@ e.g. finding summit data from reference
 """
 
 import urllib3
+import json
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules import sota_ref
 from SOTAtoADIF import __version__
 
 # things we need for API calls
-api_url_base = "https://api2.sota.org.uk/api/"
+default_api_url_base = "https://api2.sota.org.uk/api/"
+api_url_base = default_api_url_base  # may be changed with set_api_url_base(), e.g. to point at a local simulator
+api_timeout = 10.0  # seconds, for connect and read (each), so a hung API can't stall the whole run
 user_agent = "Python SOTAtoADIF v{} by G5JDA".format(__version__)
 header = {'User-Agent': user_agent}
+api_workers = 4  # number of summit lookups / revalidations made concurrently
+http = urllib3.PoolManager(maxsize=api_workers)  # pool big enough that concurrent lookups can reuse connections
+
+# summit data cache, kept between runs if loaded with load_summit_cache() and saved with save_summit_cache()
+# summit ref -> {'data': summit data, 'etag': ETag or None, 'last_modified': Last-Modified or None, 'checked': time}
+summit_cache = {}
+cache_max_age = 7 * 24 * 60 * 60  # seconds a cache entry is used without revalidating it with the API
+
+
+def set_api_url_base(url):
+    """
+    Sets the base URL used for SOTA API calls
+    :param url: API base URL, e.g. http://localhost:8080/api/ (a trailing slash is added if missing)
+    """
+    global api_url_base
+
+    if not url.endswith('/'):
+        url += '/'
+
+    logging.debug('Setting API URL base to {}'.format(url))
+    api_url_base = url
+
+
+def load_summit_cache(filepath):
+    """
+    Loads the summit data cache from file, if it exists
+    :param filepath: path to summit cache JSON file
+    """
+    global summit_cache
+
+    if not os.path.exists(filepath):
+        logging.debug('Summit cache {} does not exist yet'.format(filepath))
+        return
+
+    # a broken cache is not worth dying for, we can always rebuild it from the API
+    try:
+        with open(filepath, encoding='utf-8') as f:
+            loaded_cache = json.load(f)
+    except Exception as e:
+        logging.warning('Could not read summit cache {}, starting with an empty cache.'.format(filepath))
+        logging.debug('Error info: ' + str(e))
+        summit_cache = {}
+        return
+
+    if not isinstance(loaded_cache, dict):
+        logging.warning('Summit cache {} is not in the expected format, starting with an empty cache.'.format(filepath))
+        summit_cache = {}
+        return
+
+    # only keep entries we can actually use, the rest will be looked up again
+    summit_cache = {summit_ref: entry for summit_ref, entry in loaded_cache.items() if _cache_entry_valid(entry)}
+
+    dropped_count = len(loaded_cache) - len(summit_cache)
+    if dropped_count:
+        logging.warning('Dropped {} summit cache entries not in the expected format from {}.'.format(dropped_count,
+                                                                                                   filepath))
+
+    logging.info('Loaded {} cached summits from {}'.format(len(summit_cache), filepath))
+
+
+def _cache_entry_valid(entry):
+    """
+    Checks a summit cache entry loaded from file has the structure summit_data_from_ref() expects
+    :param entry: summit cache entry
+    :return: True if entry can be used
+    """
+    return (isinstance(entry, dict)
+            and isinstance(entry.get('data'), dict)
+            and isinstance(entry.get('checked'), (int, float)) and not isinstance(entry['checked'], bool)
+            and isinstance(entry.get('etag'), (str, type(None)))
+            and isinstance(entry.get('last_modified'), (str, type(None))))
+
+
+def save_summit_cache(filepath):
+    """
+    Saves the summit data cache to file (via a temporary file, so an interrupted save can't corrupt the cache)
+    :param filepath: path to summit cache JSON file
+    """
+    logging.debug('Saving {} cached summits to {}'.format(len(summit_cache), filepath))
+
+    try:
+        with open(filepath + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(summit_cache, f)
+        os.replace(filepath + '.tmp', filepath)
+    except Exception as e:
+        logging.warning('Could not save summit cache {}.'.format(filepath))
+        logging.debug('Error info: ' + str(e))
+
+
+def summit_cache_fresh(summit_ref):
+    """
+    Checks if a summit ref has cached data that can be used without revalidating it with the API
+    :param summit_ref: summit reference string, e.g. G/CE-001
+    :return: True if cached data is present and younger than cache_max_age
+    """
+    cached = summit_cache.get(summit_ref)
+    return bool(cached) and time.time() - cached['checked'] < cache_max_age
 
 
 def summit_data_from_ref(summit_ref):
     """
-    Retrieves summit data from SOTA API
+    Retrieves summit data from SOTA API, or from the summit cache when fresh.
+    Stale cache entries are revalidated with a conditional GET (ETag / Last-Modified), a 304 response refreshes them
+    without downloading the summit data again. If the API fails, stale cached data is used rather than none,
+    unless the API says the summit was not found (204), in which case the cache entry is dropped.
     :param summit_ref: summit reference string, e.g. G/CE-001
     :return: summit data as a dictionary if lookup succeeds, otherwise None
     """
     # return variable - if we don't successfully get the summit data, we return None
     summit_data = None
+    problem = None  # description of why the lookup failed, if it does
+
+    cached = summit_cache.get(summit_ref)
+    if summit_cache_fresh(summit_ref):
+        logging.debug("Using cached summit data for {}".format(summit_ref))
+        return cached['data']
 
     logging.debug("Retrieving summit data for {}".format(summit_ref))
 
     try:
         api_url = api_url_base + "summits/" + summit_ref
         logging.debug("Using API URL: {}".format(api_url))
-        response = urllib3.request("GET", api_url, retries=3, headers=header)  # using urllib3 global PoolManager
+
+        request_header = dict(header)
+        if cached:
+            # conditional GET, so unchanged summit data is not downloaded again
+            if cached.get('etag'):
+                request_header['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                request_header['If-Modified-Since'] = cached['last_modified']
+
+        response = http.request("GET", api_url, retries=3, timeout=api_timeout, headers=request_header)
         status_code = response.status
         logging.debug("API returned status code: {}".format(status_code))
 
@@ -53,35 +175,65 @@ def summit_data_from_ref(summit_ref):
             case 200:
                 # the good case, we expect api data to be present, decode the json
                 summit_data = response.json()
+                summit_cache[summit_ref] = {'data': summit_data,
+                                            'etag': response.headers.get('ETag'),
+                                            'last_modified': response.headers.get('Last-Modified'),
+                                            'checked': time.time()}
+
+            case 304 if cached:
+                # cached data is still current, just refresh the entry
+                logging.debug("Cached summit data for {} not modified".format(summit_ref))
+                # a 304 may carry updated validators (RFC 9110 15.4.5), keep them for the next revalidation
+                if response.headers.get('ETag'):
+                    cached['etag'] = response.headers['ETag']
+                if response.headers.get('Last-Modified'):
+                    cached['last_modified'] = response.headers['Last-Modified']
+                cached['checked'] = time.time()
+                summit_data = cached['data']
 
             case 204:
-                # most likely the summit ref was not found / is invalid
-                logging.warning("SOTA API returned status code: " + str(status_code) + ". This means summit reference"
-                                + " was not found or is bad. Summit ref: " + summit_ref +
-                                ". No enrichment for this summit!")
+                # most likely the summit ref was not found / is invalid (e.g. summit retired), so forget cached data
+                problem = ("SOTA API returned status code: " + str(status_code) + ". This means summit reference"
+                           + " was not found or is bad. Summit ref: " + summit_ref)
+                if cached:
+                    logging.debug("Removing {} from summit cache".format(summit_ref))
+                    summit_cache.pop(summit_ref, None)
+                    cached = None
 
             case 404:
                 # most likely the summit ref is malformed or the API path changed
-                logging.warning("SOTA API returned status code: " + str(status_code) +
-                                ". Either summit ref is malformed or API has changed. Summit ref: " + summit_ref +
-                                ". No enrichment for this summit!")
+                problem = ("SOTA API returned status code: " + str(status_code) +
+                           ". Either summit ref is malformed or API has changed. Summit ref: " + summit_ref)
+
+            case 429:
+                # rate limited, still happening after the retries (urllib3 retries honour the Retry-After header)
+                problem = ("SOTA API returned status code: " + str(status_code) + ". Too many requests, "
+                           + "rate limit reached. Summit ref: " + summit_ref)
 
             case code if code in range(500, 599):
                 # some sort of server error
-                logging.warning("SOTA API returned status code: " + str(status_code) + ". SOTA API may have changed "
-                                + "or is down. Summit ref: " + summit_ref + ". No enrichment for this summit!")
+                problem = ("SOTA API returned status code: " + str(status_code) + ". SOTA API may have changed "
+                           + "or is down. Summit ref: " + summit_ref)
 
             case _:
                 # some other error with the lookup, unknown
-                logging.warning("SOTA API returned status code: " + str(status_code) + ". Unknown error. Summit ref: "
-                                + summit_ref + ". No enrichment for this summit!")
+                problem = ("SOTA API returned status code: " + str(status_code) + ". Unknown error. Summit ref: "
+                           + summit_ref)
 
     # catch urllib3 errors, unfortunately not well documented what's likely to raise the many available
     # we can do better if we get reports of exceptions in the wild
     except Exception as e:
-        logging.warning("SOTA API Unknown error. Summit ref: " + summit_ref + ". No enrichment for this summit!")
+        problem = "SOTA API Unknown error. Summit ref: " + summit_ref
         logging.debug("Error info: " + str(e))
 
+    if problem:
+        if cached:
+            # better to enrich with old data than not at all
+            logging.warning(problem + ". Using stale cached summit data instead.")
+            summit_data = cached['data']
+        else:
+            logging.warning(problem + ". No enrichment for this summit!")
+
     return summit_data
 
 
@@ -105,6 +257,18 @@ def enrich_qsos(qsos_dict):
         logging.debug('API URL base {}'.format(api_url_base))
         logging.debug('User-Agent is {}'.format(user_agent))
 
+        # normalise refs and find the unique valid ones before any network I/O, malformed refs are never sent
+        summit_refs = sota_ref.normalise_qso_refs(qsos_dict)
+
+        # at most one API call per unique summit ref, none for refs with fresh cached data
+        api_count = sum(1 for summit_ref in summit_refs if not summit_cache_fresh(summit_ref))
+        logging.debug('{} summits need looking up or revalidating'.format(api_count))
+
+        # lookups / revalidations are made concurrently in batches of api_workers, results come back in order
+        with ThreadPoolExecutor(max_workers=api_workers) as executor:
+            for summit_ref, summit_data in zip(summit_refs, executor.map(summit_data_from_ref, summit_refs)):
+                checked_summits_data[summit_ref] = summit_data  # cache the summit data
+
         # nested for loops to iterate over every qso
         for callsign in qsos_dict.keys():
             for qso in qsos_dict[callsign]:
@@ -115,20 +279,13 @@ def enrich_qsos(qsos_dict):
 
                     # check summit_ref is not blank string
                     if summit_ref:
-                        # only make the API call if we do not have a cached copy of the data
-                        if summit_ref not in checked_summits_data.keys():
-                            logging.debug('Found new summit ref: {}'.format(summit_ref))
-                            summit_data = summit_data_from_ref(summit_ref)
-                            checked_summits_data[summit_ref] = summit_data  # cache the summit data
-                            api_count += 1
-
-                        # Make sure the summit data is not empty (e.g. after API call failures)
-                        summit_data = checked_summits_data[summit_ref]
+                        # Make sure the summit data is not empty (e.g. after API call failures or malformed refs)
+                        summit_data = checked_summits_data.get(summit_ref)
                         if not summit_data:
                             logging.debug('summit_data is empty, skipping enrichment')
                         else:
                             # get summit locator from the cache (default to empty string if locator key missing)
-                            summit_locator = checked_summits_data[summit_ref].get('locator', '')
+                            summit_locator = summit_data.get('locator', '')
 
                             # make sure summit locator is not empty
                             if not summit_locator:
@@ -140,6 +297,6 @@ def enrich_qsos(qsos_dict):
                                 qso[locator_key] = summit_locator
 
     logging.info("Number of unique summits found: {}.".format(str(len(checked_summits_data.keys()))))
-    logging.debug("Number of API calls: {}.".format(str(api_count)))  # should equal number of unique summits
+    logging.debug("Number of API calls: {}.".format(str(api_count)))  # unique summits without fresh cached data
 
     return qsos_dict
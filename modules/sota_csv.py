@@ -21,19 +21,58 @@ Contains functionality needed to make sense of SOTA CSV log files, process them
 """
 
 import csv
+import io
+import itertools
 import logging
+import mmap
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from modules import log_setup
+from modules import sota_ref
 
 
-def read_log(filepath):
+def make_filters(since=None, until=None, callsign=None, summit=None, date_ordered=False):
+    """
+    Builds the row filters used by read_log() / process_log_parallel() to only keep QSOs of interest.
+    Filtering happens on the raw CSV rows, so rows not selected never become QSOs or get enriched.
+    :param since: datetime.date, keep QSOs on or after this date (None for no limit)
+    :param until: datetime.date, keep QSOs on or before this date (None for no limit)
+    :param callsign: keep QSOs made with this station callsign only, case-insensitive (None for all)
+    :param summit: keep QSOs made from this summit only, canonical summit ref (None for all)
+    :param date_ordered: the log is known to be sorted by date (either way), so reading can stop at the end of the
+        date range
+    :return: filters dictionary, or None if no filters are set
+    """
+    if not (since or until or callsign or summit):
+        return None
+
+    return {'since': since.strftime('%Y%m%d') if since else None,  # same format as parse_date()
+            'until': until.strftime('%Y%m%d') if until else None,
+            'callsign': callsign.upper() if callsign else None,
+            'summit': summit,
+            'date_ordered': date_ordered}
+
+
+def read_log(filepath, filters=None):
     """
     Reads SOTA CSV log file.
-    Specifically no smart processing of the CSV log should be done in this function.
-    i.e. we can use this for activator, s2s, chaser, ...? logs without issue
+    Without filters no smart processing of the CSV log is done in this function,
+    i.e. we can use this for activator, s2s, chaser, ...? logs without issue.
+    With filters, QSO rows ('V2') not selected by them are left out (only the raw callsign, summit and date columns
+    are checked), and if filters['date_ordered'] is set reading stops at the first QSO row past the end of the date
+    range. All other rows are returned untouched for process_qsos() to deal with.
     :param filepath: path to CSV log file
+    :param filters: optional filters from make_filters()
     :return: list of rows from CSV log file (each row itself a list)
     """
     log = []
     row_count = 0
+    filtered_count = 0
+    first_date_key = None  # for date_ordered filters, to work out which way the log is sorted
+    date_direction = 0  # 1 for ascending dates, -1 for descending, 0 for not known yet
 
     logging.info('Reading SOTA CSV log {}'.format(filepath))
 
@@ -41,10 +80,33 @@ def read_log(filepath):
     with open(filepath, newline='', encoding='utf-8') as f:
         reader = csv.reader(f)
         for row in reader:
-            log.append(row)
             row_count += 1
 
+            # only QSO rows are filtered, anything else is left for process_qsos() to deal with
+            if filters and row and row[0] == 'V2' and len(row) > 3:
+                if filters['date_ordered']:
+                    date_key = parse_date(row[3])
+                    if date_key and not date_direction:
+                        if first_date_key is None:
+                            first_date_key = date_key
+                        elif date_key != first_date_key:
+                            date_direction = 1 if date_key > first_date_key else -1
+
+                    # once the log has passed the end of the date range, no later row can be selected
+                    if date_key and ((date_direction == 1 and filters['until'] and date_key > filters['until']) or
+                                     (date_direction == -1 and filters['since'] and date_key < filters['since'])):
+                        logging.debug('Passed end of date range at row {}, stopping reading'.format(row_count))
+                        break
+
+                if not _row_selected(row, filters):
+                    filtered_count += 1
+                    continue
+
+            log.append(row)
+
     logging.info('Read {} rows from {}'.format(row_count, filepath))
+    if filters:
+        logging.info('Kept {} rows, {} QSO rows did not match filters'.format(len(log), filtered_count))
 
     return log
 
@@ -56,63 +118,349 @@ def process_qsos(raw_log):
     :param raw_log: list of rows from SOTA CSV log (output of read_log)
     :return: dictionary of QSO records
     """
-    qsos_dict = {}
-
     logging.info('Processing CSV rows into QSOs.')
 
     # don't try to process an empty log
     if not raw_log:
         logging.debug('raw_log is empty')
         logging.error('No record rows present after loading CSV')
+        qsos_dict = {}
     else:
-        for record in raw_log:
-            match record[0]:
-                case 'V2':
-                    # the case for normal QSO rows - note some fields may be empty strings ''
-                    # note also that columns are consistent across activator, s2s, chaser logs (thankfully!)
-                    try:
-                        qso = {'summit': record[2],
-                               'date': record[3],
-                               'time': record[4],
-                               'frequency': record[5],
-                               'mode': record[6],
-                               'callsign': record[7],  # this is the callsign of the worked station
-                               'other_summit': record[8],  # this is summit of the worked station for s2s/chaser logs
-                               'comment': record[9]}
-
-                        # the outer keys in the qsos_dict are callsign used by log owner
-                        if record[1] in qsos_dict.keys():
-                            # already processed qsos for this callsign, append
-                            qsos_dict[record[1]].append(qso)
-                        else:
-                            # first qso for this callsign, init
-                            logging.debug('first QSO found for callsign {}'.format(record[1]))
-                            qsos_dict[record[1]] = [qso]
-
-                    except Exception as e:
-                        logging.error("\nUnknown error attempting to process log record as QSO. Record skipped: "
-                                      + record + "\nError info: " + str(e))
+        qsos_dict = _qsos_from_rows(raw_log)
 
-                    continue
+    _log_qso_counts({callsign: len(qsos) for callsign, qsos in qsos_dict.items()})
 
-                case 'Version':
-                    # skip header row present in S2S csv
-                    logging.debug('skipping S2S header row')
-                    continue
+    return qsos_dict
 
-                case '':
-                    # skip empty records
-                    logging.debug('skipping empty row')
-                    continue
 
-                case _:
-                    # default case means unexpected format
-                    logging.warning("\nUnrecognized version field in CSV row. This could mean the SOTA CSV format has"
-                                    + "changed or the CSV file imported is not a SOTA CSV. Skipping row: " + record)
-                    continue
+def process_log_parallel(filepath, workers, filters=None, prepare=None):
+    """
+    Reads and processes a SOTA CSV log file using a pool of worker processes.
+    The file is split into chunks by byte offset, each worker finds the first record starting in its chunk, parses and
+    processes the records starting in it into QSOs, and optionally prepares them (so that also runs in parallel).
+    The per-callsign results are then merged back together in original file order.
+    Output is the same as read_log() followed by process_qsos() (and prepare if given).
+    :param filepath: path to CSV log file
+    :param workers: number of worker processes to use
+    :param filters: optional filters from make_filters(), applied by the workers (date_ordered is ignored)
+    :param prepare: optional function applied by the workers to each chunk's dictionary of QSO records, returning a
+        dictionary in the same format, e.g. functools.partial(adif.prepare_qsos, log_summary=False).
+        Must be picklable, i.e. a module level function or a partial of one.
+    :return: dictionary of QSO records
+    """
+    qsos_dict = {}
+    qso_counts = {}  # QSOs found per callsign, before prepare
+
+    logging.info('Reading and processing SOTA CSV log {} using {} workers'.format(filepath, workers))
+
+    # rough chunk offsets, the workers find the record boundaries themselves
+    # (no chunks at all for an empty file, which mmap can't map and has nothing to parse anyway)
+    file_size = os.path.getsize(filepath)
+    offsets = [file_size * i // workers for i in range(workers + 1)] if file_size else [0]
+    chunk_count = len(offsets) - 1
+
+    # no try-except here either: a failed worker means the log is only partially processed, dying is best
+    # workers keep their log records and return them with their results, see log_setup.init_worker_logging()
+    with ProcessPoolExecutor(max_workers=workers, initializer=log_setup.init_worker_logging,
+                             initargs=(logging.getLogger().getEffectiveLevel(),)) as executor:
+        # map() returns results in the order submitted, which preserves the original file order
+        results = executor.map(_process_chunk, [filepath] * chunk_count, offsets[:-1], offsets[1:],
+                               [filters] * chunk_count, [prepare] * chunk_count)
+        next_start = 0  # where the previous chunk's last record ended, i.e. where this chunk must start
+
+        for (start, end, chunk_counts, chunk_dict, log_records), stop in zip(results, offsets[1:]):
+            if start != next_start:
+                # the worker's rough offset was inside a quoted field with newlines, so it started on the wrong line
+                # (rare), redo the chunk here from where the previous chunk really ended and drop its log records
+                logging.debug('Chunk started at byte {} instead of {}, processing it again'.format(start, next_start))
+                start, end, chunk_counts, chunk_dict, log_records = _process_chunk(filepath, next_start, stop,
+                                                                                   filters, prepare)
+            log_setup.write_worker_log_records(log_records)
+            next_start = end
 
-    if qsos_dict:
-        for key in qsos_dict.keys():
-            logging.info('Found {} QSOs with callsign {}.'.format(len(qsos_dict[key]), key))
+            for callsign, qsos in chunk_dict.items():
+                if callsign in qsos_dict:
+                    qsos_dict[callsign].extend(qsos)
+                else:
+                    qsos_dict[callsign] = qsos
+
+            for callsign, count in chunk_counts.items():
+                qso_counts[callsign] = qso_counts.get(callsign, 0) + count
+
+    if not qsos_dict:
+        logging.error('No QSOs present after processing CSV')
+
+    _log_qso_counts(qso_counts)
+
+    if prepare:
+        logging.info('Kept {} of {} QSOs after preparing them in the workers.'.format(
+            sum(len(qsos) for qsos in qsos_dict.values()), sum(qso_counts.values())))
+
+    return qsos_dict
+
+
+def _qsos_from_rows(raw_log):
+    """
+    Process SOTA log rows into QSO records, without any summary logging.
+    Shared by process_qsos() and the parallel chunk workers.
+    :param raw_log: list of rows from SOTA CSV log
+    :return: dictionary of QSO records
+    """
+    qsos_dict = {}
+
+    for record in raw_log:
+        match record[0]:
+            case 'V2':
+                # the case for normal QSO rows - note some fields may be empty strings ''
+                # note also that columns are consistent across activator, s2s, chaser logs (thankfully!)
+                try:
+                    qso = {'summit': record[2],
+                           'date': record[3],
+                           'time': record[4],
+                           'frequency': record[5],
+                           'mode': record[6],
+                           'callsign': record[7],  # this is the callsign of the worked station
+                           'other_summit': record[8],  # this is summit of the worked station for s2s/chaser logs
+                           'comment': record[9]}
+
+                    # the outer keys in the qsos_dict are callsign used by log owner
+                    if record[1] in qsos_dict.keys():
+                        # already processed qsos for this callsign, append
+                        qsos_dict[record[1]].append(qso)
+                    else:
+                        # first qso for this callsign, init
+                        logging.debug('first QSO found for callsign {}'.format(record[1]))
+                        qsos_dict[record[1]] = [qso]
+
+                except Exception as e:
+                    logging.error("\nUnknown error attempting to process log record as QSO. Record skipped: "
+                                  + str(record) + "\nError info: " + str(e))
+
+                continue
+
+            case 'Version':
+                # skip header row present in S2S csv
+                logging.debug('skipping S2S header row')
+                continue
+
+            case '':
+                # skip empty records
+                logging.debug('skipping empty row')
+                continue
+
+            case _:
+                # default case means unexpected format
+                logging.warning("\nUnrecognized version field in CSV row. This could mean the SOTA CSV format has"
+                                + "changed or the CSV file imported is not a SOTA CSV. Skipping row: " + str(record))
+                continue
 
     return qsos_dict
+
+
+def _log_qso_counts(qso_counts):
+    """
+    Log the number of QSOs found for each callsign
+    :param qso_counts: dictionary of callsign to number of QSOs
+    """
+    for callsign, count in qso_counts.items():
+        logging.info('Found {} QSOs with callsign {}.'.format(count, callsign))
+
+
+# QSO record fields that usually have the same value in many QSOs
+_repeated_fields = ('summit', 'date', 'time', 'frequency', 'mode', 'callsign', 'other_summit')
+
+
+def _record_start(data, offset):
+    """
+    Find the first record starting at or after a byte offset, assuming the offset is not inside a quoted field.
+    A newline only ends a record if it is outside a quoted field (comments may contain quoted newlines).
+    Quotes are read the same way as the csv module does: a quote only opens a quoted field when it is the first
+    character of a field, a doubled quote inside a quoted field is an escaped quote, and any other quote is just a
+    literal character (e.g. a comment of: he said 5" tall).
+    If the offset actually is inside a quoted field with newlines the result is wrong, process_log_parallel() checks
+    for this since the previous chunk's last record then ends somewhere else.
+    :param data: file contents (bytes or mmap)
+    :param offset: byte offset to search from
+    :return: offset of the record start, or the end of data if no record starts at or after offset
+    """
+    if offset == 0:
+        return 0
+
+    position = offset - 1  # a record starting exactly at offset follows a newline at offset - 1
+
+    # walk forward over newlines until one is found outside quoted fields
+    while True:
+        newline = data.find(b'\n', position)
+        if newline == -1:
+            return len(data)
+
+        quote = _next_field_quote(data, position, newline)
+        if quote == -1:
+            return newline + 1
+
+        # skip over the quoted field (which may contain newlines) and check again from after it
+        position = _quoted_field_end(data, quote)
+
+
+def _next_field_quote(data, start, end):
+    """
+    Find the next quote that opens a quoted field, i.e. a quote at the start of a field
+    :param data: file contents (bytes or mmap)
+    :param start: offset to search from, must be outside any quoted field
+    :param end: offset to search up to (exclusive)
+    :return: offset of the quote, or -1 if there is none before end
+    """
+    quote = data.find(b'"', start, end)
+
+    # start of field means start of file, or straight after a delimiter / line ending
+    while quote > 0 and data[quote - 1] not in b',\r\n':
+        quote = data.find(b'"', quote + 1, end)
+
+    return quote
+
+
+def _quoted_field_end(data, quote):
+    """
+    Find the end of the quoted part of a field
+    :param data: file contents (bytes or mmap)
+    :param quote: offset of the quote opening the quoted field
+    :return: offset just after the closing quote, or the end of data if the quoted field is never closed
+    """
+    closing = data.find(b'"', quote + 1)
+
+    # doubled quotes are escaped quote characters, not the end of the quoted field
+    while closing != -1 and data[closing + 1:closing + 2] == b'"':
+        closing = data.find(b'"', closing + 2)
+
+    return len(data) if closing == -1 else closing + 1
+
+
+def _process_chunk(filepath, offset, stop, filters, prepare):
+    """
+    Worker function: parse the records starting in one chunk of a CSV log file and process them into QSOs.
+    The last record may carry on past the end of the chunk, it is read up to its end so nothing is parsed twice.
+    :param filepath: path to CSV log file
+    :param offset: byte offset of the chunk start, the first record starting at or after it is the first one parsed
+    :param stop: byte offset of the chunk end, no record starting at or after it is parsed
+    :param filters: filters from make_filters() or None
+    :param prepare: function applied to the QSO records before returning them, or None
+    :return: tuple of (offset of the first record, offset just after the last record,
+        dictionary of callsign to number of QSOs found, dictionary of QSO records, list of log records)
+    """
+    rows = []
+
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = _record_start(data, offset)
+        end = start
+
+        if start < stop:
+            # read whole lines, so no multibyte character is split and csv sees every line ending
+            newline = data.find(b'\n', stop - 1)
+            line_end = len(data) if newline == -1 else newline + 1
+            text = data[start:line_end].decode('utf-8')
+            lines = io.StringIO(text, newline='')
+            overflow = _OverflowLines(data, line_end)
+
+            for row in csv.reader(itertools.chain(lines, overflow)):
+                if not (filters and row and row[0] == 'V2' and len(row) > 3) or _row_selected(row, filters):
+                    rows.append(row)
+
+                # rows only start before stop while there are lines left in text, the last row may need overflow
+                if lines.tell() == len(text) and not overflow.pending:
+                    break
+
+            end = overflow.position
+
+    logging.debug('Parsed {} rows from bytes {}-{}'.format(len(rows), start, end))
+
+    qsos_dict = _qsos_from_rows(rows)
+    qso_counts = {callsign: len(qsos) for callsign, qsos in qsos_dict.items()}
+
+    # logs repeat the same few dates, times, summits, modes... many times, interned strings are only pickled once per
+    # chunk instead of once per QSO, which halves the time the main process spends unpickling the results
+    for qsos in qsos_dict.values():
+        for qso in qsos:
+            for key in _repeated_fields:
+                qso[key] = sys.intern(qso[key])
+
+    if prepare:
+        qsos_dict = prepare(qsos_dict)
+
+    return start, end, qso_counts, qsos_dict, log_setup.take_worker_log_records()
+
+
+class _OverflowLines:
+    """
+    Iterator over the lines of data from an offset, keeping track of the offset reached.
+    Lines are split like the csv reader in read_log() sees them (open() with newline='').
+    """
+
+    def __init__(self, data, position):
+        self.data = data
+        self.position = position
+        self.pending = []  # lines split from the last line read, at lone carriage returns
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            if self.position >= len(self.data):
+                raise StopIteration
+
+            newline = self.data.find(b'\n', self.position)
+            line_end = len(self.data) if newline == -1 else newline + 1
+            text = self.data[self.position:line_end].decode('utf-8')
+            self.position = line_end
+
+            # a lone carriage return also ends a line with newline='', which io.StringIO splits for us
+            self.pending = io.StringIO(text, newline='').readlines()
+
+        return self.pending.pop(0)
+
+
+@lru_cache(maxsize=None)
+def parse_date(date):
+    """
+    Converts a SOTA CSV date (dd/mm/yyyy) to yyyymmdd, which is both the ADIF date format and sorts in date order.
+    Only the exact dd/mm/yyyy form is accepted (e.g. not 1/2/2023), so filtering and ADIF output agree on what is valid.
+    Results are cached, since logs repeat the same few dates many times.
+    :param date: date string from the CSV date column, e.g. '25/12/2023'
+    :return: e.g. '20231225', or '' if date is not a real date in the expected format
+    """
+    day, month, year = date[0:2], date[3:5], date[6:10]
+    if len(date) != 10 or date[2] != '/' or date[5] != '/' or not (day + month + year).isascii() \
+            or not (day + month + year).isdigit():
+        return ''
+
+    try:
+        datetime.strptime(date, '%d/%m/%Y')  # must be a calendar date too, e.g. not 31/02/2023
+    except ValueError:
+        return ''
+
+    return year + month + day
+
+
+def _row_selected(row, filters):
+    """
+    Checks a raw QSO row against the filters
+    :param row: QSO row from SOTA CSV log (row[0] == 'V2')
+    :param filters: filters from make_filters()
+    :return: True if the row should be kept
+    """
+    if filters['callsign'] and row[1].upper() != filters['callsign']:
+        return False
+
+    if filters['since'] or filters['until']:
+        date_key = parse_date(row[3])
+        if not date_key:
+            return False  # can't be in the date range if we can't read the date
+        if filters['since'] and date_key < filters['since']:
+            return False
+        if filters['until'] and date_key > filters['until']:
+            return False
+
+    if filters['summit'] and sota_ref.normalise_ref(row[2]) != filters['summit']:
+        return False
+
+    return True
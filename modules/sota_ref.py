@@ -0,0 +1,86 @@
+"""
+Copyright (c) 2024 Jack G5JDA (https://g5jda.uk)
+
+This file is part of SOTAtoADIF.
+
+SOTAtoADIF is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+SOTAtoADIF is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SOTAtoADIF.
+If not, see <https://www.gnu.org/licenses/>.
+
+
+
+sota_ref.py
+
+Parsing and validation of SOTA summit references, e.g. G/LD-001
+"""
+
+import logging
+import re
+import sys
+from functools import lru_cache
+
+# association (e.g. G, GW, VK3, 3Y) / region (always 2 characters) - summit number
+# whitespace around the separators and short summit numbers are tolerated since they are easily fixed
+_summit_ref_pattern = re.compile(r'^([A-Z0-9]{1,4})\s*/\s*([A-Z0-9]{2})\s*-\s*([0-9]{1,3})$')
+
+
+@lru_cache(maxsize=None)
+def normalise_ref(summit_ref):
+    """
+    Converts a summit reference to canonical ASSOC/RR-NNN form, e.g. ' g/ld-1 ' becomes 'G/LD-001'
+    Results are cached and the canonical strings interned, since logs repeat the same few refs many times.
+    :param summit_ref: summit reference string as found in the SOTA CSV
+    :return: canonical summit reference string, or None if summit_ref is malformed
+    """
+    match = _summit_ref_pattern.match(summit_ref.strip().upper())
+
+    if not match:
+        return None
+
+    association, region, number = match.groups()
+
+    return sys.intern('{}/{}-{:03d}'.format(association, region, int(number)))
+
+
+def normalise_qso_refs(qsos_dict):
+    """
+    Canonicalises 'summit' / 'other_summit' refs of every QSO in place and collects the unique valid refs.
+    Malformed refs are left as they are and reported together in one warning, they should not be looked up.
+    :param qsos_dict: Dictionary of QSOs in the format returned by process_qsos()
+    :return: list of unique canonical summit refs, in the order first seen
+    """
+    summit_refs = {}  # dict rather than set to keep first seen order (so API calls happen in log order)
+    malformed_refs = {}  # malformed ref to number of times seen
+
+    for callsign in qsos_dict.keys():
+        for qso in qsos_dict[callsign]:
+            for key in ['summit', 'other_summit']:
+                summit_ref = qso[key]
+
+                # blank refs are normal (e.g. other_summit for non-S2S QSOs)
+                if not summit_ref:
+                    continue
+
+                canonical_ref = normalise_ref(summit_ref)
+                if canonical_ref:
+                    qso[key] = canonical_ref
+                    summit_refs[canonical_ref] = None
+                else:
+                    malformed_refs[summit_ref] = malformed_refs.get(summit_ref, 0) + 1
+
+    if malformed_refs:
+        message = "\nFound {} malformed summit refs, these will not be looked up so QSOs using them will have no" \
+                  " enrichment:".format(len(malformed_refs))
+        for summit_ref, count in malformed_refs.items():
+            message += "\n    '{}' ({} times)".format(summit_ref, count)
+        logging.warning(message)
+
+    logging.debug('Found {} unique valid summit refs'.format(len(summit_refs)))
+
+    return list(summit_refs)
@@ -0,0 +1,160 @@
+"""
+Copyright (c) 2024 Jack G5JDA (https://g5jda.uk)
+
+This file is part of SOTAtoADIF.
+
+SOTAtoADIF is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+SOTAtoADIF is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SOTAtoADIF.
+If not, see <https://www.gnu.org/licenses/>.
+
+
+
+bench_enrich.py
+
+Benchmarks sota_api.enrich_qsos() against the local SOTA API simulator, no network access needed.
+Reports throughput and latency percentiles of the summit lookups sent to the API, fresh cache hits, and bytes downloaded.
+
+e.g. realistic vs degraded API:
+    python3 tools/bench_enrich.py --summits 200 --latency 150 --jitter 100
+    python3 tools/bench_enrich.py --summits 200 --latency 150 --error-rate 0.1 --timeout-rate 0.02 --hang 15
+
+e.g. cold vs warm (revalidated) summit cache:
+    python3 tools/bench_enrich.py --summits 200 --latency 150 --runs 2
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # repo root, for modules
+
+import sota_api_simulator  # noqa: E402
+from modules import sota_api  # noqa: E402
+
+
+def make_qsos(qso_count, summit_count, s2s_every):
+    """
+    Make a synthetic QSO dictionary in the format returned by sota_csv.process_qsos()
+    :param qso_count: number of QSOs
+    :param summit_count: number of unique summit refs to spread the QSOs over
+    :param s2s_every: every n-th QSO also gets an other_summit, 0 for none
+    :return: dictionary of QSO records
+    """
+    qsos = []
+
+    for i in range(qso_count):
+        other_summit = ''
+        if s2s_every and i % s2s_every == 0:
+            other_summit = 'G/BM-{:03d}'.format((i // s2s_every) % summit_count % 1000)
+
+        qsos.append({'summit': 'G/LD-{:03d}'.format(i % summit_count % 1000),
+                     'date': '01/01/2024',
+                     'time': '12:00',
+                     'frequency': '14MHz',
+                     'mode': 'CW',
+                     'callsign': 'M0ABC',
+                     'other_summit': other_summit,
+                     'comment': ''})
+
+    return {'G5JDA/P': qsos}
+
+
+def percentile(sorted_values, fraction):
+    """
+    :param sorted_values: sorted list of numbers
+    :param fraction: e.g. 0.99 for the 99th percentile
+    :return: nearest-rank percentile value, 0 if sorted_values is empty
+    """
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='bench_enrich',
+        description='Benchmark QSO enrichment against the local SOTA API simulator.')
+    parser.add_argument('--qsos', type=int, default=2000, help='number of QSOs (default %(default)s)')
+    parser.add_argument('--summits', type=int, default=100,
+                        help='number of unique summit refs, at most 1000 (default %(default)s)')
+    parser.add_argument('--s2s-every', type=int, default=5, metavar='n',
+                        help='every n-th QSO is S2S, 0 for none (default %(default)s)')
+    parser.add_argument('--client-timeout', type=float, default=sota_api.api_timeout, metavar='seconds',
+                        help='sota_api connect/read timeout (default %(default)s)')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='number of enrichment runs, the summit cache is kept between runs (default %(default)s)')
+    parser.add_argument('--cache-max-age', type=float, default=0, metavar='days',
+                        help='days before cached summit data is revalidated (like SOTAtoADIF --cache-max-age), '
+                             '0 revalidates every run (default %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show SOTAtoADIF log output')
+    sota_api_simulator.add_arguments(parser)
+    parser.set_defaults(synthesize=True)  # bench refs are made up, the fixtures will not cover them
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR, format='%(levelname)s: %(message)s')
+
+    server = sota_api_simulator.server_from_args(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sota_api.set_api_url_base(server.api_url_base)
+    sota_api.api_timeout = args.client_timeout
+    sota_api.cache_max_age = args.cache_max_age * 24 * 60 * 60
+
+    # time every lookup that goes to the API by wrapping the function enrich_qsos() calls,
+    # fresh cache hits never reach the simulator so they are only counted (their ~0 ms would skew the percentiles)
+    latencies = []
+    cache_hits = []
+    summit_data_from_ref = sota_api.summit_data_from_ref
+
+    def timed_summit_data_from_ref(summit_ref):
+        if sota_api.summit_cache_fresh(summit_ref):
+            cache_hits.append(summit_ref)
+            return summit_data_from_ref(summit_ref)
+
+        start = time.perf_counter()
+        try:
+            return summit_data_from_ref(summit_ref)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    sota_api.summit_data_from_ref = timed_summit_data_from_ref
+
+    for run in range(1, args.runs + 1):
+        latencies.clear()
+        cache_hits.clear()
+        requests_before = server.request_count
+        bytes_before = server.body_bytes
+
+        qsos_dict = make_qsos(args.qsos, args.summits, args.s2s_every)
+        time_start = time.perf_counter()
+        sota_api.enrich_qsos(qsos_dict)
+        duration = time.perf_counter() - time_start
+
+        enriched = sum(1 for qsos in qsos_dict.values() for qso in qsos if qso.get('summit_locator'))
+        latencies.sort()
+
+        print('Run {}: QSOs: {}, enriched: {}, API lookups: {}, fresh cache hits: {}'.format(
+            run, args.qsos, enriched, len(latencies), len(cache_hits)))
+        print('Total time: {:.3f} s, {:.1f} API lookups/s, {:.1f} QSOs/s'.format(
+            duration, len(latencies) / duration if duration else 0, args.qsos / duration if duration else 0))
+        if latencies:
+            print('API lookup latency ms: p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+                *(percentile(latencies, p) * 1000 for p in (0.5, 0.9, 0.99, 1.0))))
+        else:
+            print('API lookup latency ms: none, every lookup was a fresh cache hit')
+        print('Simulator requests: {}, body bytes: {}'.format(server.request_count - requests_before,
+                                                              server.body_bytes - bytes_before))
+
+    print('Simulator status counts: {}'.format(server.status_counts))
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2024 Jack G5JDA (https://g5jda.uk)
+
+This file is part of SOTAtoADIF.
+
+SOTAtoADIF is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+SOTAtoADIF is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SOTAtoADIF.
+If not, see <https://www.gnu.org/licenses/>.
+
+
+
+check_parallel_parse.py
+
+Regression check that parallel CSV parsing (-j) gives exactly the same QSOs as serial parsing, with and without
+preparing them for ADIF in the workers, for CSV logs with awkward quoting in comments (quoted newlines, stray quotes,
+escaped quotes, CRLF / lone CR line endings).
+
+    python3 tools/check_parallel_parse.py
+"""
+
+import functools
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # repo root, for modules
+
+from modules import adif  # noqa: E402
+from modules import sota_csv  # noqa: E402
+
+# each case is the CSV text of a log, chosen so that a naive split would cut a record in half
+cases = {
+    'stray quote then quoted newline':
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:15,14MHz,CW,M1ABC,,he said 5" tall\n'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:16,14MHz,CW,M1ABC,,"line one\n'
+        'V2 line two"\n'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:17,14MHz,CW,M1ABC,,last\n',
+    'escaped quotes around newlines':
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:15,14MHz,CW,M1ABC,,"a ""quoted""\n'
+        'V2,comment"\n'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:16,14MHz,CW,M1ABC,,""""\n'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:17,14MHz,CW,M1ABC,,"""\n'
+        'still quoted"\n',
+    'quoted then literal quote':
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:15,14MHz,CW,M1ABC,,"abc"de"f\n'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:16,14MHz,CW,M1ABC,,"x\n'
+        'V2 y"\n',
+    'CRLF line endings':
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:15,14MHz,CW,M1ABC,,5" tall\r\n'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:16,14MHz,CW,M1ABC,,"one\r\n'
+        'V2 two"\r\n',
+    'lone CR line endings':
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:15,14MHz,CW,M1ABC,,one\r'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:16,14MHz,CW,M1ABC,,"two\r'
+        'V2 three"\r'
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:17,14MHz,CW,M1ABC,,four\n',
+    'no trailing newline':
+        'V2,G5JDA/P,G/LD-001,01/02/2023,10:15,14MHz,CW,M1ABC,,"one\n'
+        'V2 two"',
+}
+
+
+def check_case(name, text, repeats):
+    """
+    Compare serial and parallel parsing of one case, repeated to give the splitter many places to cut
+    :param name: case name for output
+    :param text: CSV text
+    :param repeats: number of times to repeat text in the test file
+    :return: True if results match for every worker count tried
+    """
+    ok = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'log.csv')
+        with open(filepath, 'w', encoding='utf-8', newline='') as f:
+            # repeats are joined with newlines in case the case text has no trailing newline
+            f.write('\n'.join([text.removesuffix('\n')] * repeats))
+
+        expected = sota_csv.process_qsos(sota_csv.read_log(filepath))
+        # prepare_qsos() adds to the QSOs it keeps, so prepare a separately parsed copy
+        expected_prepared = adif.prepare_qsos(sota_csv.process_qsos(sota_csv.read_log(filepath)))
+        prepare = functools.partial(adif.prepare_qsos, log_summary=False)
+
+        for workers in range(2, 9):
+            result = sota_csv.process_log_parallel(filepath, workers)
+            if result != expected or list(result) != list(expected):
+                print('FAIL: {} (repeats {}, workers {})'.format(name, repeats, workers))
+                ok = False
+
+            result = sota_csv.process_log_parallel(filepath, workers, prepare=prepare)
+            if result != expected_prepared or list(result) != list(expected_prepared):
+                print('FAIL: {} prepared in workers (repeats {}, workers {})'.format(name, repeats, workers))
+                ok = False
+
+    return ok
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)s: %(message)s')
+
+    all_ok = True
+    for case_name, case_text in cases.items():
+        for case_repeats in (1, 7, 50):
+            all_ok = check_case(case_name, case_text, case_repeats) and all_ok
+
+    print('All cases OK.' if all_ok else 'Parallel parsing does not match serial parsing!')
+    sys.exit(0 if all_ok else 1)
@@ -0,0 +1,352 @@
+"""
+Copyright (c) 2024 Jack G5JDA (https://g5jda.uk)
+
+This file is part of SOTAtoADIF.
+
+SOTAtoADIF is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+SOTAtoADIF is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SOTAtoADIF.
+If not, see <https://www.gnu.org/licenses/>.
+
+
+
+sota_api_simulator.py
+
+A local stand-in for the SOTA API summits endpoint, for testing and benchmarking without network access.
+Serves summit JSON from a fixtures file, with optional latency and fault injection.
+Responses carry ETag / Last-Modified validators and conditional GETs get 304 when the summit data is unchanged.
+
+Run it, then point SOTAtoADIF at it:
+    python3 tools/sota_api_simulator.py --port 8080 --latency 150 --error-rate 0.05
+    python3 SOTAtoADIF.py --api-url http://127.0.0.1:8080/api/ <SOTA Database CSV filepath>
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+default_fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'summits.json')
+
+# summit refs we consider well-formed, anything else under /api/summits/ gets a 404 like the real API
+_summit_ref_pattern = re.compile(r'^[A-Z0-9]{1,4}/[A-Z0-9]{2}-[0-9]{3}$')
+
+
+def locator_from_lat_lon(latitude, longitude):
+    """
+    Converts a position to a 6 character Maidenhead locator
+    :param latitude: latitude in decimal degrees
+    :param longitude: longitude in decimal degrees
+    :return: locator string, e.g. 'IO84JK'
+    """
+    longitude += 180
+    latitude += 90
+
+    locator = chr(ord('A') + int(longitude // 20)) + chr(ord('A') + int(latitude // 10))
+    locator += str(int((longitude % 20) // 2)) + str(int(latitude % 10))
+    locator += chr(ord('A') + int((longitude % 2) * 12)) + chr(ord('A') + int((latitude % 1) * 24))
+
+    return locator
+
+
+def synthesize_summit(summit_ref):
+    """
+    Makes up plausible summit data for a summit ref, deterministic so repeated runs see the same data
+    :param summit_ref: summit reference string, e.g. G/LD-001
+    :return: summit data dictionary in the same shape as the fixtures
+    """
+    digest = hashlib.sha256(summit_ref.encode('utf-8')).digest()
+    latitude = round(int.from_bytes(digest[0:4], 'big') / 2 ** 32 * 140 - 70, 4)
+    longitude = round(int.from_bytes(digest[4:8], 'big') / 2 ** 32 * 360 - 180, 4)
+
+    return {'summitCode': summit_ref,
+            'name': 'Synthetic summit {}'.format(summit_ref),
+            'shortCode': summit_ref.split('/')[1],
+            'associationName': 'Synthetic',
+            'regionName': 'Synthetic',
+            'altM': digest[8] * 10,
+            'latitude': latitude,
+            'longitude': longitude,
+            'locator': locator_from_lat_lon(latitude, longitude),
+            'points': digest[9] % 10 + 1,
+            'bonusPoints': 0}
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    """
+    HTTP server holding the simulator configuration and state shared by all request handler threads
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, summits, synthesize=False, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=503, not_found_rate=0.0, timeout_rate=0.0, hang=30.0, rate_limit=0.0, seed=None):
+        """
+        :param server_address: (host, port) tuple, port 0 picks a free port
+        :param summits: dictionary of summit ref to summit data
+        :param synthesize: make up data for well-formed refs missing from summits (otherwise 204)
+        :param latency: seconds to wait before each response
+        :param jitter: extra random wait of up to this many seconds
+        :param error_rate: fraction of requests answered with error_status
+        :param error_status: HTTP status code used for injected errors
+        :param not_found_rate: fraction of requests answered with 204 regardless of summit
+        :param timeout_rate: fraction of requests that hang for hang seconds before answering
+        :param hang: seconds to hang for, set longer than the client timeout to force timeouts
+        :param rate_limit: maximum requests per second before answering 429, 0 for no limit
+        :param seed: random seed, for repeatable fault patterns
+        """
+        super().__init__(server_address, SimulatorRequestHandler)
+        self.summits = summits
+        self.synthesize = synthesize
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.not_found_rate = not_found_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.rate_limit = rate_limit
+        self.last_modified = formatdate(usegmt=True)  # all summits count as modified when the simulator started
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()  # protects random and the counters below
+        self.request_count = 0
+        self.body_bytes = 0
+        self.status_counts = {}
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def roll(self, rate):
+        """
+        :param rate: probability between 0 and 1
+        :return: True with the given probability
+        """
+        with self.lock:
+            return self.random.random() < rate
+
+    def rate_limited(self):
+        """
+        Fixed one second window rate limiter
+        :return: True if this request exceeds the rate limit
+        """
+        if not self.rate_limit:
+            return False
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_count = 0
+            self._window_count += 1
+            return self._window_count > self.rate_limit
+
+    def count(self, status, body_bytes=0):
+        """
+        Record a response for the summary
+        :param status: HTTP status code sent
+        :param body_bytes: size of the response body sent
+        """
+        with self.lock:
+            self.request_count += 1
+            self.body_bytes += body_bytes
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def handle_error(self, request, client_address):
+        # clients giving up on hung requests is expected (that's the point of --timeout-rate), don't spam tracebacks
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            logging.debug('Client {} disconnected before response was sent'.format(client_address))
+        else:
+            super().handle_error(request, client_address)
+
+    @property
+    def api_url_base(self):
+        """
+        :return: base URL to give to SOTAtoADIF --api-url / sota_api.set_api_url_base()
+        """
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/api/'.format(host, port)
+
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles GET /api/summits/<summit ref> like the SOTA API
+    """
+    server_version = 'SOTAAPISimulator'
+
+    def do_GET(self):
+        server = self.server
+
+        if server.rate_limited():
+            self.send_status(429, {'Retry-After': '1'})
+            return
+
+        delay = server.latency
+        if server.jitter:
+            with server.lock:
+                delay += server.random.uniform(0, server.jitter)
+        if server.timeout_rate and server.roll(server.timeout_rate):
+            delay = server.hang
+        if delay:
+            time.sleep(delay)
+
+        if server.error_rate and server.roll(server.error_rate):
+            self.send_status(server.error_status)
+            return
+
+        if not self.path.startswith('/api/summits/'):
+            self.send_status(404)
+            return
+
+        summit_ref = self.path.removeprefix('/api/summits/')
+        if not _summit_ref_pattern.match(summit_ref):
+            self.send_status(404)
+            return
+
+        summit_data = server.summits.get(summit_ref)
+        if summit_data is None and server.synthesize:
+            summit_data = synthesize_summit(summit_ref)
+
+        if summit_data is None or (server.not_found_rate and server.roll(server.not_found_rate)):
+            self.send_status(204)
+            return
+
+        body = json.dumps(summit_data).encode('utf-8')
+        validators = {'ETag': '"{}"'.format(hashlib.sha256(body).hexdigest()[:16]),
+                      'Last-Modified': server.last_modified}
+
+        # conditional GET, ETag takes precedence over Last-Modified like real HTTP servers
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            not_modified = if_none_match == validators['ETag']
+        else:
+            not_modified = self.headers.get('If-Modified-Since') == validators['Last-Modified']
+
+        if not_modified:
+            self.send_status(304, validators)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in validators.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        server.count(200, len(body))
+
+    def send_status(self, status, headers=None):
+        """
+        Send a response with no body
+        :param status: HTTP status code
+        :param headers: optional dictionary of extra headers
+        """
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.count(status)
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+
+def load_fixtures(filepath):
+    """
+    Load summit data fixtures
+    :param filepath: path to JSON file of summit ref to summit data
+    :return: dictionary of summit ref to summit data
+    """
+    with open(filepath, encoding='utf-8') as f:
+        summits = json.load(f)
+
+    logging.info('Loaded {} summits from {}'.format(len(summits), filepath))
+
+    return summits
+
+
+def add_arguments(parser):
+    """
+    Add the simulator options to an argument parser (shared with the enrichment benchmark)
+    :param parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--fixtures', default=default_fixtures_path,
+                        help='path to summit data fixtures JSON (default %(default)s)')
+    parser.add_argument('--synthesize', action='store_true',
+                        help='serve made up data for well-formed summit refs not in the fixtures (instead of 204)')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='ms',
+                        help='milliseconds to wait before each response')
+    parser.add_argument('--jitter', type=float, default=0.0, metavar='ms',
+                        help='extra random milliseconds (0 up to this value) to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='fraction',
+                        help='fraction of requests answered with --error-status')
+    parser.add_argument('--error-status', type=int, default=503, metavar='status',
+                        help='HTTP status code used for injected errors (default %(default)s)')
+    parser.add_argument('--not-found-rate', type=float, default=0.0, metavar='fraction',
+                        help='fraction of requests answered with 204 (summit not found)')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, metavar='fraction',
+                        help='fraction of requests that hang for --hang seconds')
+    parser.add_argument('--hang', type=float, default=30.0, metavar='seconds',
+                        help='how long hanging requests hang for (default %(default)s)')
+    parser.add_argument('--rate-limit', type=float, default=0.0, metavar='per_second',
+                        help='answer 429 once more than this many requests arrive in a second (default no limit)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for repeatable latency and fault patterns')
+
+
+def server_from_args(args, host='127.0.0.1', port=0):
+    """
+    Create a simulator server from parsed arguments (see add_arguments)
+    :param args: argparse.Namespace
+    :param host: address to listen on
+    :param port: port to listen on, 0 picks a free port
+    :return: SimulatorServer, not yet serving
+    """
+    return SimulatorServer((host, port), load_fixtures(args.fixtures),
+                           synthesize=args.synthesize,
+                           latency=args.latency / 1000,
+                           jitter=args.jitter / 1000,
+                           error_rate=args.error_rate,
+                           error_status=args.error_status,
+                           not_found_rate=args.not_found_rate,
+                           timeout_rate=args.timeout_rate,
+                           hang=args.hang,
+                           rate_limit=args.rate_limit,
+                           seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='sota_api_simulator',
+        description='Local SOTA API stand-in with latency and fault injection, for testing SOTAtoADIF offline.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default %(default)s)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(levelname)s: %(message)s')
+
+    server = server_from_args(args, args.host, args.port)
+    logging.info('Serving SOTA API simulator at {}'.format(server.api_url_base))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info('Served {} requests ({} body bytes), status counts: {}'.format(
+            server.request_count, server.body_bytes, server.status_counts))